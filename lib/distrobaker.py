@@ -1,57 +1,208 @@
+import concurrent.futures
+import contextlib
 import fedora_messaging.api as messaging
 import git
+import hashlib
+import json
 import koji
 import logging
 import os
+import pickle
 import pyrpkg
+import queue
+import random
 import regex
+import shutil
+import socketserver
+import sqlite3
 import tempfile
+import types
+import threading
+import time
+import wsgiref.simple_server
 import yaml
 
 # Global configuration config
+# This is an immutable snapshot, replaced as a whole on every reload so
+# that concurrent workers always see a consistent configuration.
 c = dict()
 
 # Retry attempts if things fail
 retry = 5
 
+# Maximum number of builds submitted in a single koji multicall
+build_batch = 100
+
+# Local directory for persistent caches, such as repository mirrors
+# None disables all persistent caching
+cache_dir = None
+
+# Number of lookaside cache files transferred in parallel for a component
+cache_jobs = 4
+
+# Maximum total size of repository mirrors in bytes; 0 means unlimited
+mirror_limit = 0
+
+# Maximum total size of cached lookaside files in bytes; 0 means unlimited
+blob_limit = 0
+
+# Seconds after which files known to exist in the destination lookaside
+# cache are checked again; 0 means they are never checked again
+index_ttl = 86400
+
+# Directory for sync workspaces; None uses the system temporary directory
+workspace_dir = None
+
+# Maximum total size of all workspaces in bytes; 0 means unlimited
+# New syncs wait while the workspaces in use exceed it
+workspace_limit = 0
+
+# Keep workspaces of successful syncs and reuse them for the next sync of
+# the same component
+workspace_reuse = False
+
+# Maximum number of concurrent operations against a single network
+# endpoint; 0 means unlimited
+endpoint_jobs = 0
+
+# Initial and maximum delay between retries of failed network operations,
+# in seconds; the delay doubles with every attempt and is randomized
+backoff = 1.0
+backoff_max = 60.0
+
+# Consecutive failures after which operations against an endpoint fail
+# immediately, and the number of seconds before it is tried again
+circuit_threshold = 10
+circuit_cooldown = 60
+
 # Workaround for messaging API callbacks
-# See process_message() for details
+# See process_message() and queue_worker() for details
 _messaging_dry_run = False
 
 # sources file regular expression
 sre = regex.compile(r'^(?>(?P<hash>[a-f0-9]{32})  (?P<file>.+)|SHA512 \((?P<file>.+)\) = (?<hash>[a-f0-9]{128}))$')
 
+# Serializes configuration loads
+_config_lock = threading.Lock()
+
+# Commit of the currently loaded configuration
+_config_commit = None
+
+# Shallow histories are deepened in steps up to this many commits before
+# fetching them completely
+_deepen_limit = 256
+
+# Configuration checkout used when persistent caching is disabled
+_config_tempdir = None
+
+# Format of compiled configurations cached on disk; bump on changes to
+# the compiled representation
+_compiled_version = 2
+
 # Generic API
 def get_config():
     return c
 
-# TODO: This needs even more error checking, e.g.
-# - check if blocks are actual dictionaries
-# - check if certain values are what we expect
 def load_config(crepo):
-    global c
-    cdir = tempfile.TemporaryDirectory(prefix='distrobaker-')
-    logging.info('Fetching configuration from {} to {}'.format(crepo, cdir.name))
-    scm = split_scmurl(crepo)
-    for attempt in range(retry):
-        try:
-            git.Repo.clone_from(scm['url'], cdir.name).git.checkout(scm['ref'])
-        except Exception as e:
-            logging.warning('Failed to fetch configuration, retrying (#{}).'.format(attempt + 1))
-            logging.error('EXCEPTION: ' + str(e))
-            continue
+    global c, _config_commit, _config_tempdir
+    with _config_lock:
+        scm = split_scmurl(crepo)
+        if cache_dir is not None:
+            root = os.path.join(cache_dir, 'config')
         else:
-            logging.info('Configuration fetched successfully.')
-            break
-    else:
-        logging.error('Failed to fetch configuration, giving up.')
+            if _config_tempdir is None:
+                _config_tempdir = tempfile.TemporaryDirectory(prefix='distrobaker-')
+            root = _config_tempdir.name
+        cdir = os.path.join(root, hashlib.sha1(scm['url'].encode('utf-8')).hexdigest())
+        logging.info('Fetching configuration from {} to {}'.format(crepo, cdir))
+        for attempt in range(retry):
+            try:
+                with endpoint('config'), git_download(cdir):
+                    if os.path.isdir(os.path.join(cdir, '.git')):
+                        repo = git.Repo(cdir)
+                        repo.git.fetch('--prune', '--tags', '--force', 'origin')
+                    else:
+                        shutil.rmtree(cdir, ignore_errors=True)
+                        repo = git.Repo.clone_from(scm['url'], cdir)
+                try:
+                    commit = repo.git.rev_parse('--verify', 'refs/remotes/origin/{}^{{commit}}'.format(scm['ref']))
+                except git.GitCommandError:
+                    commit = repo.git.rev_parse('--verify', '{}^{{commit}}'.format(scm['ref']))
+            except Exception as e:
+                logging.warning('Failed to fetch configuration, retrying (#{}).'.format(attempt + 1))
+                logging.error('EXCEPTION: ' + str(e))
+                backoff_wait(attempt, e, 'config')
+                continue
+            else:
+                logging.info('Configuration fetched successfully.')
+                break
+        else:
+            logging.error('Failed to fetch configuration, giving up.')
+            return None
+        if c and commit == _config_commit:
+            logging.info('Configuration unchanged at {}, keeping the current one.'.format(commit))
+            return c
+        n = _load_compiled(cdir + '.pickle', commit)
+        if n is None:
+            try:
+                repo.git.checkout('--force', '--detach', commit)
+            except Exception as e:
+                logging.error('Failed to check out configuration at {}.'.format(commit))
+                logging.error('EXCEPTION: ' + str(e))
+                return None
+            n = compile_config(cdir)
+            if n is None:
+                return None
+            if cache_dir is not None:
+                _save_compiled(cdir + '.pickle', commit, n)
+        c = freeze(n)
+        _config_commit = commit
+        logging.info('Configuration at {} loaded.'.format(commit))
+        return c
+
+# Returns the compiled configuration stored in path if it was compiled
+# from commit, or None
+def _load_compiled(path, commit):
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            stored = pickle.load(f)
+    except Exception as e:
+        logging.warning('Failed to load the compiled configuration from {}, ignoring.'.format(path))
+        logging.warning('EXCEPTION: ' + str(e))
+        return None
+    if stored.get('version') != _compiled_version or stored.get('commit') != commit:
         return None
+    logging.info('Using the configuration compiled at {}.'.format(commit))
+    return stored['config']
+
+# Store the configuration compiled from commit in path
+def _save_compiled(path, commit, n):
+    try:
+        fd, tmp = tempfile.mkstemp(prefix='compiled-', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'version': _compiled_version, 'commit': commit, 'config': n}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception as e:
+        logging.warning('Failed to store the compiled configuration in {}.'.format(path))
+        logging.warning('EXCEPTION: ' + str(e))
+
+# Parse and validate distrobaker.yaml in the cdir directory, compiling it
+# into plain dictionaries of settings, Component records by namespace and
+# tuples of namespaces by trigger tag.  See freeze() for the immutable
+# snapshot.
+# Returns None on errors.
+# TODO: This needs even more error checking, e.g.
+# - check if blocks are actual dictionaries
+# - check if certain values are what we expect
+def compile_config(cdir):
     # Try to load yaml
-    if os.path.isfile(os.path.join(cdir.name, 'distrobaker.yaml')):
+    if os.path.isfile(os.path.join(cdir, 'distrobaker.yaml')):
         try:
-            with open(os.path.join(cdir.name, 'distrobaker.yaml')) as f:
-                y = yaml.safe_load(f)
-            logging.debug('{} loaded, processing.'.format(os.path.join(cdir.name, 'distrobaker.yaml')))
+            with open(os.path.join(cdir, 'distrobaker.yaml')) as f:
+                y = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+            logging.debug('{} loaded, processing.'.format(os.path.join(cdir, 'distrobaker.yaml')))
         except Exception as e:
             logging.error('Could not parse distrobaker.yaml.')
             logging.error('EXCEPTION: ' + str(e))
@@ -131,6 +282,22 @@ def load_config(crepo):
         else:
             logging.error('Configuration error: build missing.')
             return None
+        n['clone'] = {'strategy': 'full', 'depth': 1, 'single_branch': False}
+        if 'clone' in cnf:
+            if 'strategy' in cnf['clone']:
+                n['clone']['strategy'] = str(cnf['clone']['strategy'])
+                if n['clone']['strategy'] not in ('full', 'blobless', 'shallow'):
+                    logging.error('Configuration error: clone.strategy must be one of full, blobless or shallow.')
+                    return None
+            if 'depth' in cnf['clone']:
+                n['clone']['depth'] = int(cnf['clone']['depth'])
+                if n['clone']['depth'] < 1:
+                    logging.error('Configuration error: clone.depth must be positive.')
+                    return None
+            if 'single_branch' in cnf['clone']:
+                n['clone']['single_branch'] = bool(cnf['clone']['single_branch'])
+        else:
+            logging.debug('Configuration: clone not defined, assuming full clones.')
         if 'git' in cnf:
             n['git'] = dict()
             for k in ('author', 'email', 'message'):
@@ -150,6 +317,11 @@ def load_config(crepo):
                 else:
                     logging.error('Configuration error: control.{} missing.'.format(k))
                     return None
+            if 'worktree' in cnf['control']:
+                n['control']['worktree'] = bool(cnf['control']['worktree'])
+            else:
+                logging.debug('Configuration: control.worktree not defined, assuming true.')
+                n['control']['worktree'] = True
         else:
             logging.error('Configuration error: control missing.')
             return None
@@ -157,140 +329,296 @@ def load_config(crepo):
         logging.error('The requires configuration block is missing.')
         return None
     components = 0
+    nc = dict()
     if 'components' in y:
-        nc = dict()
         cnf = y['components']
         for k in ('rpms', 'modules'):
             if k in cnf:
                 nc[k] = dict()
-                for p in cnf[k].keys():
+                sbase = '{}/{}/'.format(n['source']['scm'], k)
+                dbase = '{}/{}/'.format(n['destination']['scm'], k)
+                for p, pc in cnf[k].items():
                     components += 1
-                    nc[k][p] = dict()
                     for ck in ('source', 'destination'):
-                        if ck in cnf[k][p]:
-                            nc[k][p][ck] = str(cnf[k][p][ck])
-                        else:
+                        if ck not in pc:
                             logging.error('Configuration error: components.{}.{}.{} missing.'.format(k, p, ck))
                             return None
+                    source = str(pc['source'])
+                    destination = str(pc['destination'])
+                    nc[k][p] = Component(k, p, source, destination, split_scmurl(sbase + source), split_scmurl(dbase + destination))
                 logging.info('Found {} configured component(s) in the {} namespace.'.format(len(nc[k]), k))
             else:
                 logging.info('No components configured in the {} namespace.'.format(k))
     if not components:
         logging.warning('No components configured.  Nothing to do.')
-    c['main'] = n
-    c['comps'] = nc
-    return c
+    # Both namespaces may share a tag; RPMs take precedence
+    triggers = dict()
+    for k in ('rpms', 'modules'):
+        if k in n['trigger']:
+            triggers[n['trigger'][k]] = triggers.get(n['trigger'][k], ()) + (k,)
+    return {'main': n, 'comps': nc, 'triggers': triggers}
+
+# Configured component
+# An immutable record of the component with its source and destination
+# SCM URLs and branches resolved when the configuration is compiled.
+class Component:
+    __slots__ = ('ns', 'name', 'source', 'destination', 'sscm', 'dscm')
+
+    def __init__(self, ns, name, source, destination, sscm, dscm):
+        for k, v in (('ns', ns), ('name', name), ('source', source), ('destination', destination),
+                     ('sscm', types.MappingProxyType(dict(sscm))), ('dscm', types.MappingProxyType(dict(dscm)))):
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Component records are immutable.')
+
+    def __reduce__(self):
+        return (Component, (self.ns, self.name, self.source, self.destination, dict(self.sscm), dict(self.dscm)))
+
+    def __repr__(self):
+        return 'Component({}/{})'.format(self.ns, self.name)
 
 # TODO: Checkout specific ref from the configured branch if requested
 # TODO: The main config should still hold branch names but messages can request specific refs from those branches
 # TODO: For modules & merge, rewrite modulemd and merge components recurseively
-def sync_repo(comp, ns='rpms', dry_run=False):
+# Returns the synchronized destination ref, False if the destination was
+# already up to date with the source, or None on failure.
+# Unless forced, syncs are skipped without cloning anything if the source
+# and destination heads, as reported by the remotes, show that the current
+# source head has already been synchronized.
+def sync_repo(comp, ns='rpms', dry_run=False, force=False):
+    conf = get_config()
     logging.info('Synchronizing SCM for {}/{}.'.format(ns, comp))
-    tempdir = tempfile.TemporaryDirectory(prefix='repo-{}-{}-'.format(ns, comp))
-    logging.debug('Temporary directory created: {}'.format(tempdir.name))
-    logging.debug('Cloning {}/{} from {}/{}/{}'.format(ns, comp, c['main']['destination']['scm'], ns, c['comps'][ns][comp]['destination']))
-    sscm = split_scmurl('{}/{}/{}'.format(c['main']['source']['scm'], ns, c['comps'][ns][comp]['source']))
-    dscm = split_scmurl('{}/{}/{}'.format(c['main']['destination']['scm'], ns, c['comps'][ns][comp]['destination']))
-    for attempt in range(retry):
-        try:
-            repo = git.Repo.clone_from(dscm['url'], tempdir.name, branch=dscm['ref'])
-        except Exception as e:
-            logging.warning('Cloning attempt #{}/{} failed, retrying.'.format(attempt + 1, retry))
-            logging.error('EXCEPTION: ' + str(e))
-            continue
-        else:
-            break
-    else:
-        logging.error('Exhausted cloning attempts for {}/{}, skipping.'.format(ns, comp))
-        return None
-    logging.debug('Successfully cloned {}/{}.'.format(ns, comp))
-    logging.debug('Fetching upstream repository for {}/{}.'.format(ns, comp))
-    repo.git.remote('add', 'source', sscm['url'])
-    for attempt in range(retry):
+    sscm = conf['comps'][ns][comp].sscm
+    dscm = conf['comps'][ns][comp].dscm
+    if not force:
+        with timer('check'):
+            try:
+                with endpoint('source-scm'):
+                    shead = ls_remote(sscm['url'], sscm['ref'])
+                with endpoint('destination-scm'):
+                    dhead = ls_remote(dscm['url'], dscm['ref'])
+            except Exception as e:
+                logging.debug('Failed to query remote heads for {}/{}, synchronizing anyway.'.format(ns, comp))
+                logging.debug('EXCEPTION: ' + str(e))
+            else:
+                if shead is not None and dhead is not None:
+                    if conf['main']['control']['merge']:
+                        synced = get_synced(ns, comp, dhead)
+                    else:
+                        synced = dhead
+                    if synced == shead:
+                        logging.info('Component {}/{} already synchronized with {}, skipping.'.format(ns, comp, shead))
+                        return False
+    # Without a working tree, the synchronized commit is built directly
+    # from tree and commit objects in a bare repository
+    worktree = conf['main']['control']['worktree']
+    with workspace('repo-{}-{}-'.format(ns, comp), key=(ns, comp)) as ws:
+        repodir = os.path.join(ws.path, 'repo')
+        logging.debug('Cloning {}/{} from {}#{}'.format(ns, comp, dscm['url'], dscm['ref']))
+        with timer('clone'):
+            for attempt in range(retry):
+                try:
+                    with endpoint('destination-scm'):
+                        mirror = get_mirror(dscm['url'], ws)
+                        if ws.warm:
+                            try:
+                                repo = refresh_repo(conf, repodir, dscm, mirror)
+                            except Exception as e:
+                                logging.debug('Failed to refresh the warm workspace of {}/{}, cloning it again.'.format(ns, comp))
+                                logging.debug('EXCEPTION: ' + str(e))
+                                ws.warm = False
+                        if not ws.warm:
+                            shutil.rmtree(repodir, ignore_errors=True)
+                            if mirror is not None:
+                                repo = git.Repo.clone_from(mirror, repodir, branch=dscm['ref'], shared=True, bare=not worktree)
+                                repo.git.remote('set-url', 'origin', dscm['url'])
+                            else:
+                                with git_download(repodir):
+                                    repo = git.Repo.clone_from(dscm['url'], repodir, branch=dscm['ref'], bare=not worktree, **clone_options(conf))
+                except Exception as e:
+                    logging.warning('Cloning attempt #{}/{} failed, retrying.'.format(attempt + 1, retry))
+                    logging.error('EXCEPTION: ' + str(e))
+                    backoff_wait(attempt, e, 'clone')
+                    continue
+                else:
+                    break
+            else:
+                logging.error('Exhausted cloning attempts for {}/{}, skipping.'.format(ns, comp))
+                return None
+        logging.debug('Successfully cloned {}/{}.'.format(ns, comp))
+        dbase = repo.git.rev_parse('refs/heads/{}'.format(dscm['ref']))
+        logging.debug('Fetching upstream repository for {}/{}.'.format(ns, comp))
+        repo.git.remote('add', 'source', sscm['url'])
+        with timer('fetch'):
+            for attempt in range(retry):
+                try:
+                    with endpoint('source-scm'):
+                        mirror = get_mirror(sscm['url'], ws)
+                        if mirror is not None:
+                            add_alternate(repo, mirror)
+                            repo.git.remote('set-url', 'source', mirror)
+                            repo.git.fetch('source', sscm['ref'])
+                        else:
+                            with git_download(repodir):
+                                repo.git.fetch('source', sscm['ref'], **clone_options(conf, fetch=True))
+                except Exception as e:
+                    logging.warning('Fetching upstream attempt #{}/{} failed, retrying.'.format(attempt + 1, retry))
+                    logging.error('EXCEPTION: ' + str(e))
+                    backoff_wait(attempt, e, 'fetch')
+                    continue
+                else:
+                    break
+            else:
+                logging.error('Exhausted upstream fetching attempts for {}/{}, skipping.'.format(ns, comp))
+                return None
+        logging.debug('Successfully fetched upstream repository for {}/{}.'.format(ns, comp))
+        logging.debug('Configuring repository properties for {}/{}.'.format(ns, comp))
         try:
-            repo.git.fetch('source', sscm['ref'])
+            repo.git.config('user.name', conf['main']['git']['author'])
+            repo.git.config('user.email', conf['main']['git']['email'])
         except Exception as e:
-            logging.warning('Fetching upstream attempt #{}/{} failed, retrying.'.format(attempt + 1, retry))
+            logging.error('Failed configuring the git repository while processing {}/{}, skipping.'.format(ns, comp))
             logging.error('EXCEPTION: ' + str(e))
-            continue
-        else:
-            break
-    else:
-        logging.error('Exhausted upstream fetching attempts for {}/{}, skipping.'.format(ns, comp))
-        return None
-    logging.debug('Successfully fetched upstream repository for {}/{}.'.format(ns, comp))
-    logging.debug('Configuring repository properties for {}/{}.'.format(ns, comp))
-    try:
-        repo.git.config('user.name', c['main']['git']['author'])
-        repo.git.config('user.email', c['main']['git']['email'])
-    except Exception as e:
-        logging.error('Failed configuring the git repository while processing {}/{}, skipping.'.format(ns, comp))
-        logging.error('EXCEPTION: ' + str(e))
-        return None
-    if c['main']['control']['merge']:
-        logging.debug('Attempting to synchronize the {}/{} branches using the merge mechanism.'.format(ns, comp))
-        # TODO: Generate a random branch name for the temporary branch in switch
-        try:
-            actor = '{} <{}>'.format(c['main']['git']['author'], c['main']['git']['email'])
-            repo.git.checkout('source/{}'.format(sscm['ref']))
-            repo.git.switch('-c', 'source')
-            repo.git.merge('--allow-unrelated-histories', '--no-commit', '-s', 'ours', dscm['ref'])
-            repo.git.commit('--author', actor, '--allow-empty', '-m', 'Temporary working tree merge')
-            repo.git.checkout(dscm['ref'])
-            repo.git.merge('--no-commit', '--squash', 'source')
-            msg = '{}\nSource: {}#{}'.format(c['main']['git']['message'], sscm['url'], repo.git.rev_parse('source/{}'.format(sscm['ref'])))
-            msgfile = tempfile.NamedTemporaryFile(prefix='msg-{}-{}-'.format(ns, comp))
-            with open(msgfile.name, 'w') as f:
-                f.write(msg)
-            repo.git.commit('--author', actor, '--allow-empty', '-F', msgfile.name)
-        except Exception as e:
-            logging.error('Failed to merge {}/{}, skipping.'.format(ns, comp))
-            logging.error('Failed to merge EXCEPTION: ' + str(e))
             return None
-        logging.debug('Successfully merged {}/{} with upstream.'.format(ns, comp))
-    else:
-        logging.debug('Attempting to synchronize the {}/{} branches using the clean pull mechanism.'.format(ns, comp))
         try:
-            repo.git.pull('--ff-only', 'source', sscm['ref'])
+            shead = repo.git.rev_parse('source/{}'.format(sscm['ref']))
+            if conf['main']['control']['merge']:
+                unchanged = parse_synced(repo.git.log('-1', '--format=%B', 'HEAD'), sscm['url']) == shead
+            else:
+                unchanged = repo.is_ancestor(shead, 'HEAD')
         except Exception as e:
-            logging.error('Failed to perform a clean pull for {}/{}, skipping.'.format(ns, comp))
+            logging.error('Failed to inspect the {}/{} history, skipping.'.format(ns, comp))
             logging.error('EXCEPTION: ' + str(e))
             return None
-        logging.debug('Successfully pulled {}/{} from upstream.'.format(ns, comp))
-    logging.debug('Component {}/{} successfully synchronized.'.format(ns, comp))
-    if os.path.isfile(os.path.join(tempdir.name, 'sources')):
-        logging.debug('Lookaside cache sources for {}/{} found, synchronizing.'.format(ns, comp))
-        if sync_cache(comp, os.path.join(tempdir.name, 'sources'), ns=ns, dry_run=dry_run) is not None:
-            logging.debug('Lookaside cache sources for {}/{} synchronized.'.format(ns, comp))
-        else:
-            logging.error('Failed to synchronize lookaside cache sources for {}/{}, skipping.'.format(ns, comp))
-            return None
-    logging.debug('Pushing synchronized contents for {}/{}.'.format(ns, comp))
-    for attempt in range(retry):
-        try:
+        if unchanged and not force:
+            logging.info('Component {}/{} already synchronized with {}, skipping.'.format(ns, comp, shead))
             if not dry_run:
-                logging.debug('Pushing {}/{}.'.format(ns, comp))
-                repo.git.push('--set-upstream', 'origin', dscm['ref'])
-                logging.debug('Successfully pushed {}/{}.'.format(ns, comp))
+                set_synced(ns, comp, shead, repo.git.rev_parse('HEAD'))
+            ws.keep = True
+            return False
+        with timer('merge'):
+            if conf['main']['control']['merge']:
+                logging.debug('Attempting to synchronize the {}/{} branches using the merge mechanism.'.format(ns, comp))
+                msg = '{}\nSource: {}#{}'.format(conf['main']['git']['message'], sscm['url'], shead)
+                if worktree:
+                    # TODO: Generate a random branch name for the temporary branch in switch
+                    try:
+                        actor = '{} <{}>'.format(conf['main']['git']['author'], conf['main']['git']['email'])
+                        repo.git.checkout('source/{}'.format(sscm['ref']))
+                        repo.git.switch('-c', 'source')
+                        repo.git.merge('--allow-unrelated-histories', '--no-commit', '-s', 'ours', dscm['ref'])
+                        repo.git.commit('--author', actor, '--allow-empty', '-m', 'Temporary working tree merge')
+                        repo.git.checkout(dscm['ref'])
+                        repo.git.merge('--no-commit', '--squash', 'source')
+                        repo.git.commit('--author', actor, '--allow-empty', '-m', msg)
+                    except Exception as e:
+                        logging.error('Failed to merge {}/{}, skipping.'.format(ns, comp))
+                        logging.error('Failed to merge EXCEPTION: ' + str(e))
+                        return None
+                else:
+                    # The squashed merge is just the source tree committed on top of
+                    # the destination branch
+                    try:
+                        dhead = repo.git.rev_parse('refs/heads/{}'.format(dscm['ref']))
+                        commit = repo.git.commit_tree('{}^{{tree}}'.format(shead), '-p', dhead, '-m', msg)
+                        repo.git.update_ref('refs/heads/{}'.format(dscm['ref']), commit, dhead)
+                    except Exception as e:
+                        logging.error('Failed to merge {}/{}, skipping.'.format(ns, comp))
+                        logging.error('Failed to merge EXCEPTION: ' + str(e))
+                        return None
+                logging.debug('Successfully merged {}/{} with upstream.'.format(ns, comp))
             else:
-                logging.debug('Pushing {}/{} (--dry-run).'.format(ns, comp))
-                repo.git.push('--dry-run', '--set-upstream', 'origin', dscm['ref'])
-                logging.debug('Successfully pushed {}/{} (--dry-run).'.format(ns, comp))
-        except Exception as e:
-            logging.warning('Pushing attempt #{}/{} failed, retrying.'.format(attempt + 1, retry))
-            logging.error('EXCEPTION: ' + str(e))
-            continue
-        else:
-            break
-    else:
-        logging.error('Exhausted pushing attempts for {}/{}, skipping.'.format(ns, comp))
-        return None
-    logging.info('Successfully synchronized {}/{}.'.format(ns, comp))
-    return repo.git.rev_parse('HEAD')
+                logging.debug('Attempting to synchronize the {}/{} branches using the clean pull mechanism.'.format(ns, comp))
+                try:
+                    dhead = repo.git.rev_parse('refs/heads/{}'.format(dscm['ref']))
+                    deepen_history(conf, repo, repodir, 'source', sscm['ref'], dhead, shead)
+                    if worktree:
+                        with endpoint('source-scm'):
+                            repo.git.pull('--ff-only', 'source', sscm['ref'])
+                    else:
+                        if not repo.is_ancestor(dhead, shead):
+                            raise Exception('Not possible to fast-forward {} to {}.'.format(dhead, shead))
+                        repo.git.update_ref('refs/heads/{}'.format(dscm['ref']), shead, dhead)
+                except Exception as e:
+                    logging.error('Failed to perform a clean pull for {}/{}, skipping.'.format(ns, comp))
+                    logging.error('EXCEPTION: ' + str(e))
+                    return None
+                logging.debug('Successfully pulled {}/{} from upstream.'.format(ns, comp))
+        logging.debug('Component {}/{} successfully synchronized.'.format(ns, comp))
+        sources = os.path.join(repodir, 'sources')
+        if not worktree:
+            # Extract the sources file from the synchronized tree, if any
+            sources = os.path.join(repo.git_dir, 'distrobaker-sources')
+            try:
+                if os.path.isfile(sources):
+                    os.remove(sources)
+                if repo.git.ls_tree('HEAD', 'sources'):
+                    with open(sources, 'w') as f:
+                        f.write(repo.git.cat_file('blob', 'HEAD:sources'))
+            except Exception as e:
+                logging.error('Failed to read lookaside cache sources for {}/{}, skipping.'.format(ns, comp))
+                logging.error('EXCEPTION: ' + str(e))
+                return None
+        if os.path.isfile(sources):
+            logging.debug('Lookaside cache sources for {}/{} found, synchronizing.'.format(ns, comp))
+            cachedir = os.path.join(ws.path, 'cache')
+            os.makedirs(cachedir, exist_ok=True)
+            sums = sync_cache(comp, sources, ns=ns, dry_run=dry_run, conf=conf, workdir=cachedir)
+            shutil.rmtree(cachedir, ignore_errors=True)
+            if sums is not None:
+                logging.debug('Lookaside cache sources for {}/{} synchronized.'.format(ns, comp))
+            else:
+                logging.error('Failed to synchronize lookaside cache sources for {}/{}, skipping.'.format(ns, comp))
+                return None
+        logging.debug('Pushing synchronized contents for {}/{}.'.format(ns, comp))
+        with timer('push'):
+            for attempt in range(retry):
+                try:
+                    with endpoint('destination-scm'):
+                        if not dry_run:
+                            logging.debug('Pushing {}/{}.'.format(ns, comp))
+                            if worktree:
+                                repo.git.push('--set-upstream', 'origin', dscm['ref'])
+                            else:
+                                repo.git.push('origin', dscm['ref'])
+                            logging.debug('Successfully pushed {}/{}.'.format(ns, comp))
+                        else:
+                            logging.debug('Pushing {}/{} (--dry-run).'.format(ns, comp))
+                            if worktree:
+                                repo.git.push('--dry-run', '--set-upstream', 'origin', dscm['ref'])
+                            else:
+                                repo.git.push('--dry-run', 'origin', dscm['ref'])
+                            logging.debug('Successfully pushed {}/{} (--dry-run).'.format(ns, comp))
+                except Exception as e:
+                    logging.warning('Pushing attempt #{}/{} failed, retrying.'.format(attempt + 1, retry))
+                    logging.error('EXCEPTION: ' + str(e))
+                    backoff_wait(attempt, e, 'push')
+                    continue
+                else:
+                    break
+            else:
+                logging.error('Exhausted pushing attempts for {}/{}, skipping.'.format(ns, comp))
+                return None
+        if not dry_run:
+            count('distrobaker_git_bytes_total', git_push_size(repo, 'refs/heads/{}'.format(dscm['ref']), dbase), direction='upload')
+        logging.info('Successfully synchronized {}/{}.'.format(ns, comp))
+        ref = repo.git.rev_parse('HEAD')
+        if not dry_run:
+            set_synced(ns, comp, shead, ref)
+        ws.keep = True
+        return ref
 
 # TODO: Handle multiple hashes for the same filename.
 #       Perhaps via a list of tuples and a directory structure similar to download_path in tempdir
-def sync_cache(comp, sources, ns='rpms', dry_run=False):
+# Lookaside cache files are downloaded to workdir, or a workspace of
+# their own if not given.
+def sync_cache(comp, sources, ns='rpms', dry_run=False, conf=None, workdir=None):
+    if conf is None:
+        conf = get_config()
+    if workdir is None:
+        with workspace('cache-{}-{}-'.format(ns, comp)) as ws:
+            return sync_cache(comp, sources, ns=ns, dry_run=dry_run, conf=conf, workdir=ws.path)
     sums = dict()
     logging.debug('Processing lookaside cache sources for {}/{}.'.format(ns, comp))
     try:
@@ -307,68 +635,92 @@ def sync_cache(comp, sources, ns='rpms', dry_run=False):
         logging.error('Failed processing lookaside cache sources for {}/{}.'.format(ns, comp))
         logging.error('EXCEPTION: ' + str(e))
         return None
-    scache = pyrpkg.lookaside.CGILookasideCache('sha512', c['main']['source']['cache']['url'], c['main']['source']['cache']['cgi'])
-    scache.download_path = c['main']['source']['cache']['path']
-    dcache = pyrpkg.lookaside.CGILookasideCache('sha512', c['main']['destination']['cache']['url'], c['main']['destination']['cache']['cgi'])
-    dcache.download_path = c['main']['destination']['cache']['path']
-    tempdir = tempfile.TemporaryDirectory(prefix='cache-{}-{}-'.format(ns, comp))
-    logging.debug('Temporary directory created: {}'.format(tempdir.name))
-    for f in sums:
-        hashtype = 'sha512' if len(sums[f]) == 128 else 'md5'
-        # There's no API for this and .upload doesn't let us override it
-        dcache.hashtype = hashtype
-        for attempt in range(retry):
-            try:
-                if not dcache.remote_file_exists('{}/{}'.format(ns, comp), f, sums[f]):
-                    logging.debug('File {} for {}/{} not available in the destination cache, downloading.'.format(f, ns, comp))
-                    scache.download('{}/{}'.format(ns, comp), f, sums[f], os.path.join(tempdir.name, f), hashtype=hashtype)
-                    logging.debug('File {} for {}/{} successfully downloaded.  Uploading to the destination cache.'.format(f, ns, comp))
-                    if not dry_run:
-                        dcache.upload('{}/{}'.format(ns, comp), os.path.join(tempdir.name, f), sums[f])
-                        logging.debug('File {} for {}/{} successfully uploaded to the destination cache.'.format(f, ns, comp))
-                    else:
-                        logging.debug('Running in dry run mode, not uploading {} for {}/{}.'.format(f, ns, comp))
+    # Every file is checked and transferred independently, so that the
+    # downloads and uploads of different files overlap.
+    with timer('cache'), concurrent.futures.ThreadPoolExecutor(max_workers=cache_jobs, thread_name_prefix='{}/{}-cache'.format(ns, comp)) as pool:
+        futures = [pool.submit(sync_cache_file, conf, comp, f, sums[f], workdir, ns=ns, dry_run=dry_run) for f in sums]
+        results = [future.result() for future in futures]
+    if not all(results):
+        return None
+    return sums
+
+# Synchronize a single lookaside cache file, downloading it to workdir.
+# Returns True on success, False otherwise.
+def sync_cache_file(conf, comp, f, filehash, workdir, ns='rpms', dry_run=False):
+    hashtype = 'sha512' if len(filehash) == 128 else 'md5'
+    # Both caches are created per file as .upload doesn't let us override
+    # the hashtype and the objects are not safe to share between threads
+    scache = pyrpkg.lookaside.CGILookasideCache(hashtype, conf['main']['source']['cache']['url'], conf['main']['source']['cache']['cgi'])
+    scache.download_path = conf['main']['source']['cache']['path']
+    dcache = pyrpkg.lookaside.CGILookasideCache(hashtype, conf['main']['destination']['cache']['url'], conf['main']['destination']['cache']['cgi'])
+    dcache.download_path = conf['main']['destination']['cache']['path']
+    if index_known(dcache.upload_url, '{}/{}'.format(ns, comp), f, filehash):
+        logging.debug('File {} for {}/{} known to be uploaded, skipping.'.format(f, ns, comp))
+        return True
+    for attempt in range(retry):
+        try:
+            with endpoint('destination-cache'):
+                exists = dcache.remote_file_exists('{}/{}'.format(ns, comp), f, filehash)
+            if not exists:
+                logging.debug('File {} for {}/{} not available in the destination cache, downloading.'.format(f, ns, comp))
+                fetch_blob(scache, '{}/{}'.format(ns, comp), f, filehash, hashtype, os.path.join(workdir, f))
+                logging.debug('File {} for {}/{} successfully downloaded.  Uploading to the destination cache.'.format(f, ns, comp))
+                if not dry_run:
+                    with endpoint('destination-cache'):
+                        dcache.upload('{}/{}'.format(ns, comp), os.path.join(workdir, f), filehash)
+                    count('distrobaker_lookaside_bytes_total', os.path.getsize(os.path.join(workdir, f)), direction='upload')
+                    index_add(dcache.upload_url, '{}/{}'.format(ns, comp), f, filehash)
+                    logging.debug('File {} for {}/{} successfully uploaded to the destination cache.'.format(f, ns, comp))
                 else:
-                    logging.debug('File {} for {}/{} already uploaded, skipping.'.format(f, ns, comp))
-            except Exception as e:
-                logging.warning('Failed attempt #{}/{} handling {} for {}/{}, retrying.'.format(attempt + 1, retry, f, ns, comp))
-                logging.error('EXCEPTION: ' + str(e))
+                    logging.debug('Running in dry run mode, not uploading {} for {}/{}.'.format(f, ns, comp))
             else:
-                break
+                index_add(dcache.upload_url, '{}/{}'.format(ns, comp), f, filehash)
+                logging.debug('File {} for {}/{} already uploaded, skipping.'.format(f, ns, comp))
+        except Exception as e:
+            logging.warning('Failed attempt #{}/{} handling {} for {}/{}, retrying.'.format(attempt + 1, retry, f, ns, comp))
+            logging.error('EXCEPTION: ' + str(e))
+            backoff_wait(attempt, e, 'cache')
         else:
-            logging.error('Exhausted lookaside cache synchronization attempts for {}/{} while working on {}, skipping.'.format(ns, comp, f))
-            return None
-    return sums
+            break
+    else:
+        logging.error('Exhausted lookaside cache synchronization attempts for {}/{} while working on {}, skipping.'.format(ns, comp, f))
+        return False
+    return True
 
 # TODO: Implement modules
 def build_comp(comp, ref, ns='rpms', dry_run=False):
+    conf = get_config()
     logging.info('Processing build for {}/{}.'.format(ns, comp))
     if ns == 'rpms':
+        profile = conf['main']['build']['profile']
         try:
-            buildconf = koji.read_config(profile_name=c['main']['build']['profile'])
-        except Exception as e:
-            logging.error('Failed initializing koji with the {} profile while building {}/{}, skipping.'.format(c['main']['build']['profile'], ns, comp))
-            logging.error('EXCEPTION: ' + str(e))
-            return None
-        buildsys = koji.ClientSession(buildconf['server'], opts=buildconf)
-        try:
-            buildsys.gssapi_login()
+            buildsys = get_koji_session(profile)
         except Exception as e:
-            logging.error('Failed authenticating against koji while building {}/{}, skipping.'.format(ns, comp))
+            logging.error('Failed initializing an authenticated koji session with the {} profile while building {}/{}, skipping.'.format(profile, ns, comp))
             logging.error('EXCEPTION: ' + str(e))
             return None
         try:
             if not dry_run:
-                task = buildsys.build('{}/{}/{}#{}'.format(c['main']['build']['prefix'], ns, comp, ref), c['main']['build']['target'], { 'scratch': c['main']['build']['scratch'] })
-                logging.info('Build submitted for {}/{}; task {}; SCMURL: {}/{}/{}#{}.'.format(ns, comp, task, c['main']['build']['prefix'], ns, comp, ref))
+                scmurl = '{}/{}/{}#{}'.format(conf['main']['build']['prefix'], ns, comp, ref)
+                opts = { 'scratch': conf['main']['build']['scratch'] }
+                with timer('build'), endpoint('koji'):
+                    try:
+                        task = buildsys.build(scmurl, conf['main']['build']['target'], opts)
+                    except koji.AuthExpired:
+                        logging.debug('Koji session expired, logging in again.')
+                        buildsys = new_koji_session(profile)
+                        task = buildsys.build(scmurl, conf['main']['build']['target'], opts)
+                logging.info('Build submitted for {}/{}; task {}; SCMURL: {}/{}/{}#{}.'.format(ns, comp, task, conf['main']['build']['prefix'], ns, comp, ref))
                 return task
             else:
-                logging.info('Running in the dry mode, not submitting any builds for {}/{} ({}/{}/{}#{}).'.format(ns, comp, c['main']['build']['prefix'], ns, comp, ref))
+                logging.info('Running in the dry mode, not submitting any builds for {}/{} ({}/{}/{}#{}).'.format(ns, comp, conf['main']['build']['prefix'], ns, comp, ref))
                 return 0
         except Exception as e:
-            logging.error('Failed submitting build for {}/{} ({}/{}/{}#{}).'.format(ns, comp, c['main']['build']['prefix'], ns, comp, ref))
+            logging.error('Failed submitting build for {}/{} ({}/{}/{}#{}).'.format(ns, comp, conf['main']['build']['prefix'], ns, comp, ref))
             logging.error('EXCEPTION: ' + str(e))
             return None
+        finally:
+            put_koji_session(profile, buildsys)
     elif ns == 'modules':
         logging.critical('Cannot build {}/{}; module building not implemented.'.format(ns, comp))
         return None
@@ -376,11 +728,200 @@ def build_comp(comp, ref, ns='rpms', dry_run=False):
         logging.critical('Cannot build {}/{}; unknown namespace.'.format(ns, comp))
         return None
 
+# Submit builds for several components of the same namespace, batching
+# the submissions into koji multicalls of up to build_batch builds each.
+# items is a list of (comp, ref) tuples.
+# Returns a dictionary mapping components to task IDs, or None on failure.
+def build_comps(items, ns='rpms', dry_run=False):
+    conf = get_config()
+    if ns != 'rpms' or dry_run:
+        return {comp: build_comp(comp, ref, ns=ns, dry_run=dry_run) for comp, ref in items}
+    results = dict()
+    profile = conf['main']['build']['profile']
+    try:
+        buildsys = get_koji_session(profile)
+    except Exception as e:
+        logging.error('Failed initializing an authenticated koji session with the {} profile while building {} {} component(s), skipping.'.format(profile, len(items), ns))
+        logging.error('EXCEPTION: ' + str(e))
+        return {comp: None for comp, _ in items}
+    try:
+        for i in range(0, len(items), build_batch):
+            batch = items[i:i + build_batch]
+            logging.info('Submitting {} build(s) in the {} namespace in a single multicall.'.format(len(batch), ns))
+            try:
+                with timer('build'), endpoint('koji'):
+                    try:
+                        calls = _multicall_builds(buildsys, conf, batch, ns)
+                    except koji.AuthExpired:
+                        logging.debug('Koji session expired, logging in again.')
+                        buildsys = new_koji_session(profile)
+                        calls = _multicall_builds(buildsys, conf, batch, ns)
+            except Exception as e:
+                logging.error('Failed submitting a batch of {} build(s) in the {} namespace.'.format(len(batch), ns))
+                logging.error('EXCEPTION: ' + str(e))
+                for comp, _ in batch:
+                    results[comp] = None
+                continue
+            for comp, ref, call in calls:
+                try:
+                    results[comp] = call.result
+                    logging.info('Build submitted for {}/{}; task {}; SCMURL: {}/{}/{}#{}.'.format(ns, comp, results[comp], conf['main']['build']['prefix'], ns, comp, ref))
+                except Exception as e:
+                    logging.error('Failed submitting build for {}/{} ({}/{}/{}#{}).'.format(ns, comp, conf['main']['build']['prefix'], ns, comp, ref))
+                    logging.error('EXCEPTION: ' + str(e))
+                    results[comp] = None
+    finally:
+        put_koji_session(profile, buildsys)
+    return results
+
+def _multicall_builds(buildsys, conf, batch, ns):
+    calls = list()
+    with buildsys.multicall(strict=False) as m:
+        for comp, ref in batch:
+            calls.append((comp, ref, m.build('{}/{}/{}#{}'.format(conf['main']['build']['prefix'], ns, comp, ref),
+                                             conf['main']['build']['target'], { 'scratch': conf['main']['build']['scratch'] })))
+    return calls
+
+# Rename the current thread after the component for the duration so that
+# log lines of concurrent workers can be told apart.
+@contextlib.contextmanager
+def component_context(comp, ns='rpms'):
+    thread = threading.current_thread()
+    name = thread.name
+    thread.name = '{}/{}'.format(ns, comp)
+    try:
+        yield
+    finally:
+        thread.name = name
+
+# Synchronize and build a single component.
+# Returns a status string; one of 'built', 'unchanged', 'sync-failed' or
+# 'build-failed'.
+def process_component(comp, ns='rpms', dry_run=False, force=False):
+    with component_context(comp, ns=ns):
+        ref = sync_component(comp, ns=ns, dry_run=dry_run, force=force)
+        if ref is None:
+            status = 'sync-failed'
+        elif ref is False:
+            status = 'unchanged'
+        else:
+            build = build_comp(comp, ref, ns=ns, dry_run=dry_run)
+            if build is None:
+                logging.error('Failed to submit a build for {}/{}.'.format(ns, comp))
+                status = 'build-failed'
+            else:
+                logging.info('Build for {}/{} submitted: {}'.format(ns, comp, build))
+                status = 'built'
+        count('distrobaker_components_total', status=status)
+        return status
+
+# Synchronize a single component, logging failures.
+# Returns the synchronized ref, False if already up to date or None on failure.
+def sync_component(comp, ns='rpms', dry_run=False, force=False):
+    with component_context(comp, ns=ns), timer('sync'):
+        ref = sync_repo(comp, ns=ns, dry_run=dry_run, force=force)
+        if ref is None:
+            logging.error('Failed to sync {}/{}, not attempting to build anything.'.format(ns, comp))
+        elif ref is False:
+            logging.info('Component {}/{} unchanged, not attempting to build anything.'.format(ns, comp))
+        return ref
+
+# Synchronize and build all configured components, or only those selected
+# in comps, a dictionary of namespaces and lists of component names.
+# Components are synchronized by a pool of jobs workers, each sync getting
+# its own temporary git workspace.  Builds of the synchronized components
+# are submitted in koji multicall batches as the syncs complete.
+# Components already up to date are skipped unless force is set.  A run
+# over all components records the catch-up checkpoint at its start and
+# the components that failed.
+# Returns a dictionary mapping result states to lists of ns/comp strings.
+def oneshot(comps=None, jobs=1, dry_run=False, force=False):
+    conf = get_config()
+    start = time.time()
+    todo = list()
+    # XXX: Only handling rpms at the moment
+    for ns in ('rpms', ):
+        if not comps:
+            if ns in conf['comps']:
+                selected = conf['comps'][ns].keys()
+            else:
+                logging.info('No components configured in the {} namespace.'.format(ns))
+                continue
+        else:
+            if ns in comps:
+                selected = comps[ns]
+            else:
+                logging.info('No components selected in the {} namespace.'.format(ns))
+                continue
+        for comp in sorted(selected, key=str.lower):
+            if ns not in conf['comps'] or comp not in conf['comps'][ns]:
+                logging.warning('Selected component "{}/{}" not configured, skipping.'.format(ns, comp))
+                continue
+            todo.append((ns, comp))
+    logging.info('Processing {} component(s) using {} worker(s).'.format(len(todo), jobs))
+    results = {'built': list(), 'unchanged': list(), 'sync-failed': list(), 'build-failed': list()}
+    pending = dict()
+
+    def submit(ns):
+        builds = build_comps(pending.pop(ns), ns=ns, dry_run=dry_run)
+        for comp in builds:
+            results['built' if builds[comp] is not None else 'build-failed'].append('{}/{}'.format(ns, comp))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='oneshot') as pool:
+        futures = dict()
+        for ns, comp in todo:
+            futures[pool.submit(sync_component, comp, ns=ns, dry_run=dry_run, force=force)] = (ns, comp)
+        for future in concurrent.futures.as_completed(futures):
+            ns, comp = futures[future]
+            try:
+                ref = future.result()
+            except Exception as e:
+                logging.error('Unexpected failure while processing {}/{}.'.format(ns, comp))
+                logging.error('EXCEPTION: ' + str(e))
+                ref = None
+            if ref is None:
+                results['sync-failed'].append('{}/{}'.format(ns, comp))
+                continue
+            if ref is False:
+                results['unchanged'].append('{}/{}'.format(ns, comp))
+                continue
+            pending.setdefault(ns, list()).append((comp, ref))
+            if len(pending[ns]) >= build_batch:
+                submit(ns)
+    for ns in list(pending):
+        submit(ns)
+    for status in results:
+        results[status].sort(key=str.lower)
+        count('distrobaker_components_total', len(results[status]), status=status)
+    logging.info('Oneshot summary: {} built, {} unchanged, {} failed to sync, {} failed to build.'.format(
+        len(results['built']), len(results['unchanged']), len(results['sync-failed']), len(results['build-failed'])))
+    for status in ('sync-failed', 'build-failed'):
+        if results[status]:
+            logging.warning('Components in the {} state: {}'.format(status, ' '.join(results[status])))
+    # A complete run covers all triggers up to its start, except those of
+    # the components that failed, which remain as far behind as before
+    if not comps and not dry_run:
+        since = get_checkpoint()
+        for status in results:
+            for name in results[status]:
+                ns, comp = name.split('/', 1)
+                record_result(comp, ns, status, since if since is not None else start)
+        checkpoint(start)
+    return results
+
 def process_message(msg):
     # Messaging requires callbacks with a single argument.
-    # An ugly workaround for now.
-    dry_run = _messaging_dry_run
+    # The actual work happens in queue_worker(); this only queues
+    # the triggered components so that the listener never blocks.
+    with timer('message'):
+        _process_message(msg)
+    if not _messaging_dry_run:
+        checkpoint()
+
+def _process_message(msg):
+    conf = get_config()
     logging.debug('Received a message with topic {}.'.format(msg.topic))
+    count('distrobaker_messages_total')
     if msg.topic.endswith('buildsys.tag'):
         try:
             logging.debug('Processing a tagging event message.')
@@ -390,38 +931,1022 @@ def process_message(msg):
         except Exception as e:
             logging.error('Failed to process the message: {}'.format(msg))
             logging.error('EXCEPTION: ' + str(e))
-        if tag == c['main']['trigger']['rpms']:
+            return
+        namespaces = conf['triggers'].get(tag, ())
+        if 'rpms' in namespaces:
             logging.debug('Message tag configured as an RPM trigger, processing.')
-            if comp in c['comps']['rpms']:
+            if comp in conf['comps'].get('rpms', ()):
                 logging.info('Handling an RPM trigger for {}, tag {}.'.format(comp, tag))
-                ref = sync_repo(comp, ns='rpms', dry_run=dry_run)
-                if ref is not None:
-                    task = build_comp(comp, ref, ns='rpms', dry_run=dry_run)
-                    if task is not None:
-                        logging.info('Build submission of {}/{} complete, task {}, trigger processed.'.format('rpms', comp, task))
-                    else:
-                        logging.error('Build submission of {}/{} failed, aborting.trigger.'.format('rpms', comp))
-                else:
-                    logging.error('Synchronization of {}/{} failed, aborting trigger.'.format('rpms', comp))
+                enqueue(comp, ns='rpms')
             else:
                 logging.debug('RPM component {} not configured for sync, ignoring.'.format(comp))
-        elif tag == c['main']['trigger']['modules']:
+        elif 'modules' in namespaces:
             logging.error('The message matches our module configuration but module building not implemented, ignoring.')
         else:
             logging.debug('Message tag not configured as a trigger, ignoring.')
     else:
         logging.warning('Unable to handle {} topics, ignoring.'.format(msg.topic))
 
+# Work queue
+# Triggered components are queued and processed by a pool of workers, see
+# start_workers().  Every component is queued or processed at most once at
+# any time; triggers arriving while a component is queued are dropped and
+# those arriving while it is being processed are merged into a single
+# follow-up sync.  The time of the earliest trigger not yet handled is
+# tracked per component for the catch-up checkpoint, see checkpoint().
+_queue = queue.Queue()
+_queue_lock = threading.Lock()
+_queue_state = dict()
+_queue_since = dict()
+_queue_active = dict()
+_queue_stats = {'queued': 0, 'coalesced': 0, 'processed': 0, 'wait': 0.0, 'maxwait': 0.0}
+
+# Queue the component for synchronization and build, triggered at the
+# received time or now
+def enqueue(comp, ns='rpms', received=None):
+    key = (ns, comp)
+    if received is None:
+        received = time.time()
+    with _queue_lock:
+        _queue_since[key] = min(received, _queue_since.get(key, received))
+        state = _queue_state.get(key)
+        if state is None:
+            _queue_state[key] = 'queued'
+            _queue_stats['queued'] += 1
+            _queue.put((ns, comp, time.time()))
+        else:
+            if state == 'running':
+                _queue_state[key] = 'rerun'
+            _queue_stats['coalesced'] += 1
+    if state is None:
+        logging.debug('Component {}/{} queued, queue depth {}.'.format(ns, comp, _queue.qsize()))
+    else:
+        logging.info('Component {}/{} already {}, merging the trigger.'.format(ns, comp, 'being processed' if state != 'queued' else 'queued'))
+
+# Returns a dictionary of work queue statistics; the current queue depth,
+# components in progress, total queued, coalesced and processed triggers,
+# and the average and maximum time spent in the queue in seconds.
+def queue_stats():
+    with _queue_lock:
+        stats = dict(_queue_stats)
+        stats['running'] = sum(1 for state in _queue_state.values() if state != 'queued')
+    stats['depth'] = _queue.qsize()
+    stats['wait'] = stats['wait'] / stats['processed'] if stats['processed'] else 0.0
+    return stats
+
+# Process queued components forever
+def queue_worker():
+    # Messaging requires callbacks with a single argument.
+    # An ugly workaround for now.
+    dry_run = _messaging_dry_run
+    while True:
+        ns, comp, queued = _queue.get()
+        wait = time.time() - queued
+        with _queue_lock:
+            _queue_state[(ns, comp)] = 'running'
+            _queue_active[(ns, comp)] = _queue_since.pop((ns, comp), queued)
+            _queue_stats['processed'] += 1
+            _queue_stats['wait'] += wait
+            _queue_stats['maxwait'] = max(_queue_stats['maxwait'], wait)
+        observe('distrobaker_queue_wait_seconds', wait)
+        logging.info('Processing {}/{} after {:.1f} seconds in the queue, queue depth {}.'.format(ns, comp, wait, _queue.qsize()))
+        try:
+            status = process_component(comp, ns=ns, dry_run=dry_run)
+        except Exception as e:
+            logging.error('Unexpected failure while processing {}/{}.'.format(ns, comp))
+            logging.error('EXCEPTION: ' + str(e))
+            status = 'sync-failed'
+        if not dry_run:
+            record_result(comp, ns, status, _queue_active[(ns, comp)])
+        with _queue_lock:
+            if _queue_state[(ns, comp)] == 'rerun':
+                logging.info('Component {}/{} triggered again while being processed, queueing a follow-up sync.'.format(ns, comp))
+                _queue_state[(ns, comp)] = 'queued'
+                _queue_stats['queued'] += 1
+                _queue.put((ns, comp, time.time()))
+            else:
+                del _queue_state[(ns, comp)]
+            del _queue_active[(ns, comp)]
+        if not dry_run:
+            checkpoint()
+        _queue.task_done()
+
+# Start jobs daemon threads processing the work queue
+def start_workers(jobs=1):
+    for i in range(jobs):
+        threading.Thread(target=queue_worker, name='worker-{}'.format(i), daemon=True).start()
+    logging.info('Started {} queue worker(s).'.format(jobs))
+
+# Catch-up
+# The time before which every trigger has been handled is recorded in
+# cache_dir/catchup.json, along with the components whose processing
+# failed and the time of their earliest unhandled trigger.  After a
+# downtime, catchup() queries the koji tag history of the RPM trigger tag
+# since then and queues only the components tagged in the meantime, plus
+# the failed ones.
+_catchup_lock = threading.Lock()
+_catchup_failed = None
+
+# Seconds of tag history before the checkpoint examined again, allowing
+# for clock differences between the hub and this host
+_catchup_margin = 300
+
+def _catchup_file():
+    return os.path.join(cache_dir, 'catchup.json')
+
+def _load_catchup():
+    with _catchup_lock:
+        try:
+            with open(_catchup_file()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning('Failed to load the catch-up checkpoint, ignoring.')
+            logging.warning('EXCEPTION: ' + str(e))
+            return None
+
+# Returns the recorded checkpoint time, or None if there is none
+def get_checkpoint():
+    if cache_dir is None:
+        return None
+    data = _load_catchup()
+    return data['time'] if data is not None else None
+
+# Returns the failed components, as a dictionary of ns/comp strings and
+# the times of their earliest unhandled triggers.  Call with _queue_lock
+# held.
+def _failed_components():
+    global _catchup_failed
+    if _catchup_failed is None:
+        data = _load_catchup()
+        _catchup_failed = dict(data.get('failed', dict())) if data is not None else dict()
+    return _catchup_failed
+
+# Record the status of processing the component triggered at received.
+# Failures keep the checkpoint from moving past received until the
+# component is processed successfully.
+def record_result(comp, ns, status, received):
+    if cache_dir is None:
+        return
+    key = '{}/{}'.format(ns, comp)
+    with _queue_lock:
+        failed = _failed_components()
+        if status in ('sync-failed', 'build-failed'):
+            failed[key] = min(received, failed.get(key, received))
+        else:
+            failed.pop(key, None)
+
+# Record ts as the checkpoint time, unless an earlier trigger is still
+# queued, being processed or failed.  Defaults to now.
+def checkpoint(ts=None):
+    if cache_dir is None:
+        return
+    if ts is None:
+        ts = time.time()
+    with _queue_lock:
+        failed = dict(_failed_components())
+        ts = min([ts] + list(_queue_since.values()) + list(_queue_active.values()) + list(failed.values()))
+    with _catchup_lock:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='catchup-', dir=cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'time': ts, 'failed': failed}, f)
+        os.replace(tmp, _catchup_file())
+
+# Queue all configured RPM components tagged into the trigger tag since
+# the checkpoint or failed earlier, each once.  The checkpoint only moves
+# past them once they have been processed successfully.
+# Returns the sorted list of queued components or None on failure.
+def catchup():
+    conf = get_config()
+    since = get_checkpoint()
+    if since is None:
+        logging.warning('No catch-up checkpoint recorded, skipping the catch-up.')
+        return list()
+    if 'rpms' not in conf['main']['trigger']:
+        logging.warning('No RPM trigger configured, skipping the catch-up.')
+        return list()
+    tag = conf['main']['trigger']['rpms']
+    profile = conf['main']['build']['profile']
+    logging.info('Catching up with tags into {} since {}.'.format(tag, time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(since))))
+    for attempt in range(retry):
+        try:
+            buildsys = get_koji_session(profile)
+            try:
+                with endpoint('koji'):
+                    history = buildsys.queryHistory(tables=['tag_listing'], tag=tag, after=since - _catchup_margin)
+            finally:
+                put_koji_session(profile, buildsys)
+        except Exception as e:
+            logging.warning('Querying tag history attempt #{}/{} failed, retrying.'.format(attempt + 1, retry))
+            logging.error('EXCEPTION: ' + str(e))
+            backoff_wait(attempt, e, 'catchup')
+            continue
+        else:
+            break
+    else:
+        logging.error('Exhausted tag history querying attempts, not catching up.')
+        return None
+    tagged = set(entry['name'] for entry in history['tag_listing'] if entry['create_ts'] >= since - _catchup_margin)
+    comps = sorted(comp for comp in tagged if comp in conf['comps'].get('rpms', ()))
+    logging.info('{} component(s) tagged into {} since the checkpoint, {} configured for sync.'.format(len(tagged), tag, len(comps)))
+    with _queue_lock:
+        failed = {key.split('/', 1)[1]: ts for key, ts in _failed_components().items() if key.startswith('rpms/')}
+    failed = {comp: ts for comp, ts in failed.items() if comp in conf['comps'].get('rpms', ())}
+    if failed:
+        logging.info('Retrying {} component(s) that failed before.'.format(len(failed)))
+    for comp in comps:
+        enqueue(comp, ns='rpms', received=min(since, failed.get(comp, since)))
+    for comp in sorted(set(failed) - set(comps)):
+        enqueue(comp, ns='rpms', received=failed[comp])
+    return sorted(set(comps) | set(failed))
+
 # TODO: Implement this
 # TODO: Get SCMURL for the given build
 # TODO: Might need to check for modules and ask MBS if needed
 def get_buildinfo(comp, build):
     pass
 
+# Network endpoints
+# Every network operation runs against one of a few named endpoints:
+# source-scm, destination-scm, source-cache, destination-cache, koji and
+# config.  Each endpoint limits the number of concurrent operations to
+# endpoint_jobs and tracks consecutive failures.  After circuit_threshold
+# of them the circuit opens and further operations fail immediately with
+# EndpointUnavailable for circuit_cooldown seconds.  The first operation
+# after that probes the endpoint again; a success closes the circuit and
+# a failure keeps it open for another cooldown period.  Only transport
+# failures count; an endpoint rejecting a build or a non-fast-forward push
+# is still available.
+_endpoint_lock = threading.Lock()
+_endpoints = dict()
+
+# git errors caused by the transport rather than the repository contents
+_git_transport_errors = regex.compile(r'could not resolve|unable to (access|connect)|failed to connect|connection (refused|reset|timed out|closed)|timed out|network is unreachable|the remote end hung up|early eof|rpc failed|returned error: 5\d\d', regex.IGNORECASE)
+
+class EndpointUnavailable(Exception):
+    pass
+
+# Returns True if the exception e is a transport failure of the endpoint
+# rather than an application error reported by it.
+def transport_error(e):
+    if isinstance(e, git.GitCommandError):
+        return _git_transport_errors.search(str(e.stderr)) is not None
+    if isinstance(e, koji.GenericError):
+        return isinstance(e, koji.ServerOffline)
+    if isinstance(e, pyrpkg.errors.UploadError) and e.http_status is not None:
+        return e.http_status >= 500
+    if isinstance(e, (pyrpkg.errors.DownloadError, pyrpkg.errors.UploadError)):
+        # Network errors are wrapped by pyrpkg, HTTP errors reported as text
+        return bool(e.args) and isinstance(e.args[0], Exception) or regex.search(r'status code 5\d\d', str(e)) is not None
+    return isinstance(e, OSError)
+
+def _endpoint(name):
+    with _endpoint_lock:
+        if name not in _endpoints:
+            _endpoints[name] = {
+                'semaphore': threading.BoundedSemaphore(endpoint_jobs) if endpoint_jobs else None,
+                'failures': 0,
+                'opened': None,
+            }
+        return _endpoints[name]
+
+# Run the enclosed network operation against the named endpoint.
+# Raises EndpointUnavailable while the endpoint circuit is open.
+@contextlib.contextmanager
+def endpoint(name):
+    state = _endpoint(name)
+    with _endpoint_lock:
+        if state['opened'] is not None:
+            if time.monotonic() - state['opened'] < circuit_cooldown:
+                raise EndpointUnavailable('Endpoint {} unavailable after {} consecutive failures.'.format(name, state['failures']))
+            # Let this operation probe the endpoint, failing others fast
+            # for another cooldown period in the meantime
+            state['opened'] = time.monotonic()
+    if state['semaphore'] is not None:
+        state['semaphore'].acquire()
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        if not transport_error(e):
+            # The endpoint answered, so it is reachable
+            _endpoint_available(name, state)
+            raise
+        count('distrobaker_endpoint_failures_total', endpoint=name)
+        with _endpoint_lock:
+            state['failures'] += 1
+            if state['failures'] >= circuit_threshold:
+                if state['opened'] is None:
+                    logging.warning('Endpoint {} failed {} times in a row, failing fast for {} seconds.'.format(name, state['failures'], circuit_cooldown))
+                state['opened'] = time.monotonic()
+        raise
+    else:
+        _endpoint_available(name, state)
+    finally:
+        observe('distrobaker_endpoint_seconds', time.monotonic() - start, endpoint=name)
+        if state['semaphore'] is not None:
+            state['semaphore'].release()
+
+def _endpoint_available(name, state):
+    with _endpoint_lock:
+        if state['opened'] is not None:
+            logging.info('Endpoint {} available again.'.format(name))
+        state['failures'] = 0
+        state['opened'] = None
+
+# Wait before the next attempt after attempt of operation failed with the
+# exception e.  The delay grows exponentially with full jitter, so that
+# workers failing together do not retry together.  There is no point in
+# waiting after the last attempt or while the endpoint circuit is open.
+def backoff_wait(attempt, e, operation):
+    if attempt + 1 >= retry:
+        return
+    count('distrobaker_retries_total', operation=operation)
+    if isinstance(e, EndpointUnavailable):
+        return
+    delay = random.uniform(0, min(backoff_max, backoff * 2 ** attempt))
+    logging.debug('Waiting {:.1f} seconds before the next attempt.'.format(delay))
+    time.sleep(delay)
+
+# Metrics
+# Counters and histograms are kept in memory, keyed by metric name and a
+# sorted tuple of label pairs.  Durations of sync phases are recorded in
+# the distrobaker_phase_seconds histogram, labelled with the phase.  The
+# metrics are served in the Prometheus text format by metrics_app() in the
+# service mode and summarized by metrics_summary() in the one-shot mode.
+_metrics_lock = threading.Lock()
+_counters = dict()
+_histograms = dict()
+_buckets = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+def count(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = {'buckets': [0] * len(_buckets), 'count': 0, 'sum': 0.0, 'max': 0.0}
+        for i, bound in enumerate(_buckets):
+            if value <= bound:
+                h['buckets'][i] += 1
+        h['count'] += 1
+        h['sum'] += value
+        h['max'] = max(h['max'], value)
+
+# Forget all recorded metrics
+def reset_metrics():
+    with _metrics_lock:
+        _counters.clear()
+        _histograms.clear()
+
+# Record the duration of the enclosed block as the given sync phase
+@contextlib.contextmanager
+def timer(phase):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe('distrobaker_phase_seconds', time.monotonic() - start, phase=phase)
+
+# Format label pairs for the Prometheus text format
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+# Returns all metrics in the Prometheus text exposition format
+def metrics_text():
+    with _metrics_lock:
+        counters = dict(_counters)
+        histograms = {key: dict(h, buckets=list(h['buckets'])) for key, h in _histograms.items()}
+    lines = list()
+    for name in sorted(set(name for name, _ in counters)):
+        lines.append('# TYPE {} counter'.format(name))
+        for key in sorted(k for k in counters if k[0] == name):
+            lines.append('{}{} {}'.format(name, _labels(key[1]), counters[key]))
+    for name in sorted(set(name for name, _ in histograms)):
+        lines.append('# TYPE {} histogram'.format(name))
+        for key in sorted(k for k in histograms if k[0] == name):
+            h = histograms[key]
+            for bound, n in zip(_buckets, h['buckets']):
+                lines.append('{}_bucket{} {}'.format(name, _labels(key[1], (('le', bound), )), n))
+            lines.append('{}_bucket{} {}'.format(name, _labels(key[1], (('le', '+Inf'), )), h['count']))
+            lines.append('{}_sum{} {}'.format(name, _labels(key[1]), h['sum']))
+            lines.append('{}_count{} {}'.format(name, _labels(key[1]), h['count']))
+    stats = queue_stats()
+    for stat in ('depth', 'running'):
+        lines.append('# TYPE distrobaker_queue_{} gauge'.format(stat))
+        lines.append('distrobaker_queue_{} {}'.format(stat, stats[stat]))
+    return '\n'.join(lines) + '\n'
+
+# Returns a dictionary summarizing all metrics, suitable for JSON output.
+# Counters map label strings to values, histograms map them to the number
+# of observations and their total, average and maximum.
+def metrics_summary():
+    summary = {'counters': dict(), 'histograms': dict()}
+    with _metrics_lock:
+        for (name, labels), value in sorted(_counters.items()):
+            summary['counters'].setdefault(name, dict())[','.join('{}={}'.format(k, v) for k, v in labels)] = value
+        for (name, labels), h in sorted(_histograms.items()):
+            summary['histograms'].setdefault(name, dict())[','.join('{}={}'.format(k, v) for k, v in labels)] = {
+                'count': h['count'],
+                'sum': round(h['sum'], 3),
+                'avg': round(h['sum'] / h['count'], 3),
+                'max': round(h['max'], 3),
+            }
+    return summary
+
+# WSGI application serving the metrics at / and /metrics
+def metrics_app(environ, start_response):
+    if environ.get('PATH_INFO', '/') not in ('/', '/metrics'):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not found\n']
+    body = metrics_text().encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'), ('Content-Length', str(len(body)))])
+    return [body]
+
+class _MetricsServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+class _MetricsHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug('Metrics request from {}: {}'.format(self.address_string(), format % args))
+
+# Serve metrics_app() on port in a daemon thread
+def serve_metrics(port, address=''):
+    server = wsgiref.simple_server.make_server(address, port, metrics_app, server_class=_MetricsServer, handler_class=_MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info('Serving metrics on port {}.'.format(port))
+
+# Koji sessions
+# Authenticated koji sessions are kept in a pool per profile and reused
+# across builds.  Sessions are not thread-safe; every borrowed session
+# must be returned with put_koji_session() once done.
+_koji_lock = threading.Lock()
+_koji_sessions = dict()
+_koji_configs = dict()
+
+# Returns an authenticated koji session for profile, reusing an idle one
+# if available.  Raises on failures.
+def get_koji_session(profile):
+    with _koji_lock:
+        if _koji_sessions.get(profile):
+            return _koji_sessions[profile].pop()
+    with endpoint('koji'):
+        return new_koji_session(profile)
+
+# Returns a new authenticated koji session for profile.  Raises on failures.
+def new_koji_session(profile):
+    with _koji_lock:
+        buildconf = _koji_configs.get(profile)
+    if buildconf is None:
+        buildconf = koji.read_config(profile_name=profile)
+        with _koji_lock:
+            _koji_configs[profile] = buildconf
+    buildsys = koji.ClientSession(buildconf['server'], opts=buildconf)
+    buildsys.gssapi_login()
+    logging.debug('Opened a new koji session with the {} profile.'.format(profile))
+    return buildsys
+
+def put_koji_session(profile, buildsys):
+    with _koji_lock:
+        _koji_sessions.setdefault(profile, list()).append(buildsys)
+
+# Synchronization state
+# The source commit last synchronized into every component's destination
+# branch is recorded in cache_dir/synced.json, along with the resulting
+# destination commit, so that unchanged components can be detected
+# without cloning anything.
+_synced_lock = threading.Lock()
+_synced = None
+
+# Merge commit message source reference regular expression
+synre = regex.compile(r'^Source: (?P<url>.+)#(?P<hash>[0-9a-f]{40})$', regex.MULTILINE)
+
+def _synced_file():
+    return os.path.join(cache_dir, 'synced.json')
+
+def _load_synced():
+    global _synced
+    if _synced is None:
+        _synced = dict()
+        if os.path.isfile(_synced_file()):
+            try:
+                with open(_synced_file()) as f:
+                    _synced = json.load(f)
+            except Exception as e:
+                logging.warning('Failed to load the synchronization state, ignoring.')
+                logging.warning('EXCEPTION: ' + str(e))
+    return _synced
+
+# Returns the source commit synchronized into the dhead destination commit
+# of the component, or None if unknown.  Falls back to the Source line of
+# the commit message if the commit is available in a local mirror.
+def get_synced(ns, comp, dhead):
+    if cache_dir is None:
+        return None
+    conf = get_config()
+    with _synced_lock:
+        state = _load_synced().get('{}/{}'.format(ns, comp))
+    if state is not None and state['destination'] == dhead:
+        return state['source']
+    sscm = conf['comps'][ns][comp].sscm
+    dscm = conf['comps'][ns][comp].dscm
+    mirror = os.path.join(cache_dir, 'mirrors', hashlib.sha1(dscm['url'].encode('utf-8')).hexdigest() + '.git')
+    try:
+        return parse_synced(git.Repo(mirror).git.log('-1', '--format=%B', dhead), sscm['url'])
+    except Exception:
+        return None
+
+# Record the source commit synchronized into the dhead destination commit
+def set_synced(ns, comp, shead, dhead):
+    if cache_dir is None:
+        return
+    with _synced_lock:
+        synced = _load_synced()
+        synced['{}/{}'.format(ns, comp)] = {'source': shead, 'destination': dhead}
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='synced-', dir=cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(synced, f)
+        os.replace(tmp, _synced_file())
+
+# Returns the source commit recorded in a merge commit message for the
+# given source URL, or None if there is none
+def parse_synced(message, url):
+    result = None
+    for m in synre.finditer(message):
+        if m.group('url') == url:
+            result = m.group('hash')
+    return result
+
+# Workspaces
+# Every sync works in its own directory handed out by workspace() from
+# workspace_dir.  Workspaces are removed as soon as the sync finishes,
+# whether it succeeds or not.  With workspace_reuse, workspaces of
+# successful repository syncs are kept warm instead and handed out again
+# for the next sync of the same component.  While the workspaces exceed
+# workspace_limit, warm ones are removed, least recently used first, and
+# new syncs wait for others to finish.  The sizes of workspaces in use are
+# sampled at most every _workspace_sample seconds, outside of the lock,
+# and warm ones are measured once on release.
+_workspace_cond = threading.Condition()
+_workspaces_active = dict()
+_workspaces_warm = dict()
+_workspace_usage = 0
+_workspace_sample = 10
+
+class Workspace:
+    def __init__(self, path, key=None, warm=False):
+        self.path = path
+        self.key = key
+        # Whether the workspace holds the result of an earlier sync
+        self.warm = warm
+        # Set once the contents are fit for reuse
+        self.keep = False
+        self._callbacks = list()
+
+    # Call func with args once the workspace is released
+    def on_release(self, func, *args):
+        self._callbacks.append((func, args))
+
+# Hand out a workspace for the duration of the block, named with prefix.
+# Warm workspaces are only reused for the same key.
+@contextlib.contextmanager
+def workspace(prefix, key=None):
+    ws = _acquire_workspace(prefix, key)
+    try:
+        yield ws
+    finally:
+        _release_workspace(ws)
+
+# Hand out the warm workspace of key or a new one once the workspaces fit
+# within workspace_limit, removing warm ones first.  Syncs are never held
+# back if no other workspace is in use.
+def _acquire_workspace(prefix, key):
+    global _workspace_usage
+    root = workspace_dir if workspace_dir is not None else tempfile.gettempdir()
+    waiting = False
+    while True:
+        if workspace_limit:
+            _sample_workspaces()
+        evict = None
+        with _workspace_cond:
+            warm = _workspaces_warm.pop(key, None) if key is not None else None
+            if warm is not None:
+                path, size, _ = warm
+                _workspaces_active[path] = (size, time.monotonic())
+                logging.debug('Reusing the warm workspace {}.'.format(path))
+                return Workspace(path, key=key, warm=True)
+            if not workspace_limit or _workspace_usage < workspace_limit or not (_workspaces_active or _workspaces_warm):
+                os.makedirs(root, exist_ok=True)
+                path = tempfile.mkdtemp(prefix=prefix, dir=root)
+                # Due for sampling by the next acquisition
+                _workspaces_active[path] = (0, time.monotonic() - _workspace_sample)
+                logging.debug('Workspace created: {}'.format(path))
+                return Workspace(path, key=key)
+            if _workspaces_warm:
+                evict = min(_workspaces_warm, key=lambda k: _workspaces_warm[k][2])
+                path, size, _ = _workspaces_warm.pop(evict)
+                _workspace_usage -= size
+            else:
+                if not waiting:
+                    logging.info('Workspaces use {} bytes, over the limit; waiting for other syncs to finish.'.format(_workspace_usage))
+                    waiting = True
+                _workspace_cond.wait(_workspace_sample)
+        if evict is not None:
+            logging.debug('Removing the warm workspace {} ({} bytes).'.format(path, size))
+            shutil.rmtree(path, ignore_errors=True)
+
+# Measure the workspaces in use not sampled for _workspace_sample seconds
+def _sample_workspaces():
+    global _workspace_usage
+    now = time.monotonic()
+    with _workspace_cond:
+        stale = [path for path, (_, sampled) in _workspaces_active.items() if now - sampled >= _workspace_sample]
+        for path in stale:
+            # Keep other threads from measuring the same workspace
+            _workspaces_active[path] = (_workspaces_active[path][0], now)
+    for path in stale:
+        size = dir_size(path)
+        with _workspace_cond:
+            if path in _workspaces_active:
+                _workspace_usage += size - _workspaces_active[path][0]
+                _workspaces_active[path] = (size, time.monotonic())
+
+def _release_workspace(ws):
+    global _workspace_usage
+    for func, args in ws._callbacks:
+        func(*args)
+    keep = workspace_reuse and ws.keep and ws.key is not None
+    if keep:
+        size = dir_size(ws.path)
+    else:
+        shutil.rmtree(ws.path, ignore_errors=True)
+        logging.debug('Workspace removed: {}'.format(ws.path))
+    old = None
+    with _workspace_cond:
+        _workspace_usage -= _workspaces_active.pop(ws.path)[0]
+        if keep:
+            old = _workspaces_warm.pop(ws.key, None)
+            if old is not None:
+                _workspace_usage -= old[1]
+            _workspaces_warm[ws.key] = (ws.path, size, time.monotonic())
+            _workspace_usage += size
+        _workspace_cond.notify_all()
+    if old is not None:
+        shutil.rmtree(old[0], ignore_errors=True)
+
+# Repository mirrors
+# Bare mirrors of the source and destination repositories are kept in
+# cache_dir/mirrors, named after a hash of their SCM URL.  Mirrors are
+# refreshed with incremental fetches before every sync and workspaces
+# borrow their objects via alternates, so that only new objects are
+# transferred over the network.  Once mirror_limit is exceeded, the least
+# recently used mirrors not borrowed by any workspace are removed.
+_mirror_lock = threading.Lock()
+_mirror_locks = dict()
+_mirror_users = dict()
+_mirror_sizes = dict()
+
+# Returns the path to a freshly updated mirror of url, or None if mirroring
+# is disabled.  The mirror is kept from eviction until the workspace is
+# released.  Raises on network failures.
+def get_mirror(url, workspace):
+    if cache_dir is None:
+        return None
+    root = os.path.join(cache_dir, 'mirrors')
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.git')
+    with _mirror_lock:
+        lock = _mirror_locks.setdefault(path, threading.Lock())
+        _mirror_users[path] = _mirror_users.get(path, 0) + 1
+    workspace.on_release(_release_mirror, path)
+    with lock:
+        if os.path.isdir(path):
+            logging.debug('Refreshing the mirror of {} in {}.'.format(url, path))
+            with git_download(path):
+                git.Repo(path).git.fetch('--prune', 'origin')
+        else:
+            logging.debug('Creating a mirror of {} in {}.'.format(url, path))
+            tmp = tempfile.mkdtemp(prefix='mirror-', dir=root)
+            try:
+                with git_download(tmp):
+                    git.Repo.clone_from(url, tmp, mirror=True)
+            except Exception:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            os.rename(tmp, path)
+        os.utime(path)
+        size = dir_size(path)
+    with _mirror_lock:
+        _mirror_sizes[path] = size
+    evict_mirrors()
+    return path
+
+def _release_mirror(path):
+    with _mirror_lock:
+        _mirror_users[path] -= 1
+
+# Remove the least recently used mirrors until their total size fits
+# within mirror_limit.  Mirrors currently in use are never removed.
+def evict_mirrors():
+    if cache_dir is None or not mirror_limit:
+        return
+    root = os.path.join(cache_dir, 'mirrors')
+    with _mirror_lock:
+        mirrors = list()
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if not name.endswith('.git'):
+                continue
+            if path not in _mirror_sizes:
+                _mirror_sizes[path] = dir_size(path)
+            mirrors.append((os.stat(path).st_mtime, path))
+        total = sum(_mirror_sizes[path] for _, path in mirrors)
+        for _, path in sorted(mirrors):
+            if total <= mirror_limit:
+                break
+            if _mirror_users.get(path):
+                continue
+            logging.info('Evicting the repository mirror {} ({} bytes).'.format(path, _mirror_sizes[path]))
+            shutil.rmtree(path, ignore_errors=True)
+            total -= _mirror_sizes.pop(path)
+
+# Lookaside file blobs
+# Files downloaded from the source lookaside cache are kept in
+# cache_dir/blobs/hashtype/hash.  pyrpkg verifies every download against
+# its hash, so a stored blob can be reused by any component, branch or
+# later run without checking it again.  Once blob_limit is exceeded, the
+# least recently used blobs are removed; access times are tracked
+# explicitly so that file modification times are preserved for uploads.
+_blob_lock = threading.Lock()
+_blob_locks = dict()
+_blob_sizes = None
+_blob_tmps = set()
+
+# Place the file f with the given hash at outfile, downloading it from
+# scache into the blob store unless already stored there.  Falls back to
+# a plain download if caching is disabled.  Raises on failures.
+def fetch_blob(scache, name, f, filehash, hashtype, outfile):
+    if cache_dir is None:
+        with endpoint('source-cache'):
+            scache.download(name, f, filehash, outfile, hashtype=hashtype)
+        count('distrobaker_lookaside_bytes_total', os.path.getsize(outfile), direction='download')
+        return
+    root = os.path.join(cache_dir, 'blobs', hashtype)
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, filehash)
+    with _blob_lock:
+        lock = _blob_locks.setdefault(path, threading.Lock())
+    with lock:
+        if os.path.isfile(path):
+            logging.debug('Reusing the cached blob of {} for {}.'.format(f, name))
+        else:
+            with _blob_lock:
+                tmp = tempfile.mkdtemp(prefix='blob-', dir=root)
+                _blob_tmps.add(os.path.abspath(tmp))
+            try:
+                with endpoint('source-cache'):
+                    scache.download(name, f, filehash, os.path.join(tmp, f), hashtype=hashtype)
+                count('distrobaker_lookaside_bytes_total', os.path.getsize(os.path.join(tmp, f)), direction='download')
+                os.replace(os.path.join(tmp, f), path)
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+                with _blob_lock:
+                    _blob_tmps.discard(os.path.abspath(tmp))
+            _add_blob(path)
+        st = os.stat(path)
+        os.utime(path, (time.time(), st.st_mtime))
+        try:
+            os.link(path, outfile)
+        except OSError:
+            shutil.copy2(path, outfile)
+    evict_blobs()
+
+def _add_blob(path):
+    global _blob_sizes
+    with _blob_lock:
+        if _blob_sizes is not None:
+            _blob_sizes[path] = os.stat(path).st_size
+
+# Remove the least recently used blobs until their total size fits within
+# blob_limit.  Blobs currently being fetched are never removed; temporary
+# download directories left behind by earlier runs are.
+def evict_blobs():
+    global _blob_sizes
+    if cache_dir is None or not blob_limit:
+        return
+    with _blob_lock:
+        if _blob_sizes is None:
+            _blob_sizes = dict()
+            for root, dirs, files in os.walk(os.path.join(cache_dir, 'blobs')):
+                for d in [d for d in dirs if d.startswith('blob-')]:
+                    dirs.remove(d)
+                    if os.path.abspath(os.path.join(root, d)) not in _blob_tmps:
+                        logging.debug('Removing the stale blob download {}.'.format(os.path.join(root, d)))
+                        shutil.rmtree(os.path.join(root, d), ignore_errors=True)
+                for f in files:
+                    _blob_sizes[os.path.join(root, f)] = os.stat(os.path.join(root, f)).st_size
+        for path in [path for path in _blob_sizes if not os.path.isfile(path)]:
+            del _blob_sizes[path]
+        total = sum(_blob_sizes.values())
+        if total <= blob_limit:
+            return
+        blobs = sorted((os.stat(path).st_atime, path) for path in _blob_sizes if os.path.isfile(path))
+        for _, path in blobs:
+            if total <= blob_limit:
+                break
+            lock = _blob_locks.setdefault(path, threading.Lock())
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                logging.debug('Evicting the cached blob {} ({} bytes).'.format(path, _blob_sizes[path]))
+                os.unlink(path)
+            except OSError:
+                pass
+            finally:
+                lock.release()
+            total -= _blob_sizes.pop(path)
+
+# Destination lookaside cache index
+# Files known to exist in the destination lookaside cache are recorded in
+# cache_dir/lookaside.db, keyed by the cache upload URL, the namespaced
+# component name, the file name and its hash, so that repeated syncs can
+# skip the remote existence check.  Entries older than index_ttl seconds
+# are ignored and revalidated against the cache.
+_index_lock = threading.Lock()
+_index_db = None
+
+def _index():
+    global _index_db
+    if _index_db is None:
+        os.makedirs(cache_dir, exist_ok=True)
+        _index_db = sqlite3.connect(os.path.join(cache_dir, 'lookaside.db'), check_same_thread=False)
+        _index_db.execute('CREATE TABLE IF NOT EXISTS present '
+                          '(cache TEXT, name TEXT, filename TEXT, hash TEXT, checked REAL, '
+                          'PRIMARY KEY (cache, name, filename, hash))')
+        _index_db.commit()
+    return _index_db
+
+# Returns True if the file is known to exist in the given cache
+def index_known(cache, name, f, filehash):
+    if cache_dir is None:
+        return False
+    with _index_lock:
+        row = _index().execute('SELECT checked FROM present WHERE cache = ? AND name = ? AND filename = ? AND hash = ?',
+                               (cache, name, f, filehash)).fetchone()
+    if row is None:
+        return False
+    return not index_ttl or time.time() - row[0] < index_ttl
+
+# Record the file as present in the given cache
+def index_add(cache, name, f, filehash):
+    if cache_dir is None:
+        return
+    with _index_lock:
+        db = _index()
+        db.execute('INSERT OR REPLACE INTO present VALUES (?, ?, ?, ?, ?)', (cache, name, f, filehash, time.time()))
+        db.commit()
+
+# Forget all files recorded as present in the given cache
+def index_clear(cache):
+    if cache_dir is None:
+        return
+    with _index_lock:
+        db = _index()
+        db.execute('DELETE FROM present WHERE cache = ?', (cache,))
+        db.commit()
+
 # Utility functions
+# Bring the repository left in repodir by an earlier sync up to date with
+# the destination branch, fetching from the mirror if given, and drop any
+# leftovers of that sync.  Returns the repository.  Raises on failures.
+def refresh_repo(conf, repodir, dscm, mirror=None):
+    worktree = conf['main']['control']['worktree']
+    repo = git.Repo(repodir)
+    if repo.bare == worktree:
+        raise Exception('Workspace repository type does not match the configuration.')
+    if 'source' in [remote.name for remote in repo.remotes]:
+        repo.git.remote('remove', 'source')
+    repo.git.remote('set-url', 'origin', dscm['url'])
+    if mirror is not None:
+        add_alternate(repo, mirror)
+        url, opts = mirror, dict()
+    else:
+        url, opts = 'origin', clone_options(conf, fetch=True)
+    with git_download(repodir):
+        if worktree:
+            repo.git.fetch(url, '+refs/heads/{0}:refs/remotes/origin/{0}'.format(dscm['ref']), **opts)
+        else:
+            repo.git.fetch(url, '+refs/heads/{0}:refs/heads/{0}'.format(dscm['ref']), **opts)
+    if worktree:
+        repo.git.checkout('--force', '-B', dscm['ref'], 'origin/{}'.format(dscm['ref']))
+        repo.git.clean('-ffdx')
+        if repo.git.branch('--list', 'source'):
+            repo.git.branch('-D', 'source')
+    return repo
+
 def split_scmurl(scmurl):
     scm = scmurl.split('#', 1)
     return {
         'url': scm[0],
         'ref': scm[1] if len(scm) >= 2 else 'master'
     }
+
+# Returns git clone keyword arguments for the configured clone strategy,
+# or git fetch arguments if fetch is set
+def clone_options(conf, fetch=False):
+    opts = dict()
+    if conf['main']['clone']['strategy'] == 'blobless':
+        opts['filter'] = 'blob:none'
+    elif conf['main']['clone']['strategy'] == 'shallow':
+        opts['depth'] = conf['main']['clone']['depth']
+    if conf['main']['clone']['single_branch'] and not fetch:
+        opts['single_branch'] = True
+    return opts
+
+# Deepen the shallow history of ref fetched from remote into repo until
+# it reaches the commit base, in steps growing from the configured depth,
+# so that a fast-forward from base to head can be verified.  Only fetches
+# the complete history once the steps exceed _deepen_limit commits.  Does
+# nothing for complete repositories.  Raises on failures.
+def deepen_history(conf, repo, repodir, remote, ref, base, head):
+    step = conf['main']['clone']['depth']
+    name = 'source-scm' if remote == 'source' else 'destination-scm'
+    while os.path.isfile(os.path.join(repo.git_dir, 'shallow')) and not repo.is_ancestor(base, head):
+        with endpoint(name), git_download(repodir):
+            if step > _deepen_limit:
+                logging.debug('Fetching the complete history of {} from {}.'.format(ref, remote))
+                repo.git.fetch('--unshallow', remote, ref)
+                return
+            logging.debug('Deepening the history of {} from {} by {} commits.'.format(ref, remote, step))
+            repo.git.fetch('--deepen={}'.format(step), remote, ref)
+        step *= 2
+
+# Let repo borrow objects from another local repository
+def add_alternate(repo, other):
+    objects = os.path.join(other, 'objects')
+    alternates = os.path.join(repo.git_dir, 'objects', 'info', 'alternates')
+    if os.path.isfile(alternates):
+        with open(alternates) as f:
+            if objects in f.read().splitlines():
+                return
+    with open(alternates, 'a') as f:
+        f.write(objects + '\n')
+
+# Total size of all files under path, in bytes
+def dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+# Count the growth of the object store of the git repository at path
+# during the enclosed operation as bytes downloaded.  Git does not report
+# transfer sizes, but received packs are stored much as they were sent.
+@contextlib.contextmanager
+def git_download(path):
+    before = dir_size(_git_objects(path))
+    yield
+    count('distrobaker_git_bytes_total', max(0, dir_size(_git_objects(path)) - before), direction='download')
+
+def _git_objects(path):
+    if os.path.isdir(os.path.join(path, '.git')):
+        return os.path.join(path, '.git', 'objects')
+    return os.path.join(path, 'objects')
+
+# Returns the size of the objects reachable from ref but not from base in
+# repo, i.e. roughly what pushing ref to a remote at base sends, in bytes.
+# Returns 0 if git cannot tell.
+def git_push_size(repo, ref, base):
+    try:
+        return int(repo.git.rev_list('--objects', '--disk-usage', '--missing=allow-any', ref, '--not', base))
+    except Exception as e:
+        logging.debug('Failed to determine the size of the push of {}.'.format(ref))
+        logging.debug('EXCEPTION: ' + str(e))
+        return 0
+
+# Returns a read-only deep copy of a dictionary
+def freeze(d):
+    return types.MappingProxyType({k: freeze(v) if isinstance(v, dict) else v for k, v in d.items()})
+
+# Returns the commit the branch ref points to in the remote repository at
+# url, or None if there is no such branch.  Raises on failures.
+def ls_remote(url, ref):
+    for l in git.cmd.Git().ls_remote(url, 'refs/heads/{}'.format(ref)).splitlines():
+        h, name = l.split('\t', 1)
+        if name == 'refs/heads/{}'.format(ref):
+            return h
+    return None